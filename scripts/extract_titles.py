@@ -63,13 +63,7 @@ def extract_titles(
     titles = []
     for entry in all_pages:
         if 'title' in entry:
-            title = entry['title']
-            # Handle case where title is a byte string
-            if isinstance(title, bytes):
-                title = title.decode('utf-8', errors='replace')
-                if debug:
-                    logger.debug(f"Decoded byte string title: {title}")
-            titles.append(title)
+            titles.append(entry['title'])
     
     logger.info(f"Extracted {len(titles)} titles")
     
@@ -80,9 +80,6 @@ def extract_training_titles(output_path="titles.json", target_count=1000, debug=
     page_id_map = {}
     for page in unused_pages:
         page_id = page["page_id"]
-        # Convert bytes to string if needed
-        if isinstance(page_id, bytes):
-            page_id = page_id.decode('utf-8')
         
         # Only add if not already in the map (prioritize first occurrence)
         if page_id not in page_id_map:
@@ -108,9 +105,6 @@ def extract_training_titles(output_path="titles.json", target_count=1000, debug=
         page = page_id_map[page_id]
         if "title" in page and page["title"]:
             title = page["title"]
-            # Convert bytes to string if needed
-            if isinstance(title, bytes):
-                title = title.decode('utf-8')
             
             # Filter out single-character titles and very short titles
             if len(title) >= 3 and not title.startswith('"') and not title.startswith("'"):
@@ -132,10 +126,7 @@ def extract_training_titles(output_path="titles.json", target_count=1000, debug=
         existing_titles = set()
         for p in all_db_pages:
             if "title" in p and p["title"]:
-                title = p["title"]
-                if isinstance(title, bytes):
-                    title = title.decode('utf-8')
-                existing_titles.add(title)
+                existing_titles.add(p["title"])
         
         # Fetch more random titles than needed to account for potential duplicates
         random_titles = get_random_wikipedia_titles(additional_needed * 2)
@@ -186,8 +186,14 @@ class WikipediaFetcher:
                 logger.debug(f"No revisions found for {title}")
             return []
 
+        # Batch revision logging into a single changelog write
+        with self.changelog.bulk_update():
+            return self._log_revisions(page_id, title, page["revisions"])
+
+    def _log_revisions(self, page_id: str, title: str, revisions: List[Dict]) -> List[Dict]:
+        """Save and log each fetched revision of a page."""
         entries = []
-        for i, rev in enumerate(page["revisions"], 1):
+        for i, rev in enumerate(revisions, 1):
             if self.debug:
                 logger.debug(f"Processing revision {i} (ID: {rev['revid']}) for {title}")
                 
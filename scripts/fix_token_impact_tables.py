@@ -111,20 +111,17 @@ def fix_token_impact_tables(db_path="data/changelog.db"):
             # Create top_tokens table if it doesn't exist
             cursor.execute('''
             CREATE TABLE IF NOT EXISTS top_tokens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
                 token_impact_id INTEGER NOT NULL,
-                token_id INTEGER NOT NULL,
                 position INTEGER NOT NULL,
+                token_id INTEGER NOT NULL,
                 impact REAL NOT NULL,
                 context_start INTEGER NOT NULL,
                 context_end INTEGER NOT NULL,
+                PRIMARY KEY (token_impact_id, position),
                 FOREIGN KEY (token_impact_id) REFERENCES token_impacts (id) ON DELETE CASCADE
-            )
+            ) WITHOUT ROWID
             ''')
             
-            # Create index for top_tokens
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_top_tokens_token_impact_id ON top_tokens (token_impact_id)')
-            
             # Commit changes
             conn.commit()
             print("Database schema created successfully")
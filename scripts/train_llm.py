@@ -7,10 +7,11 @@ import argparse
 import hashlib
 import json
 import logging
+import math
 import os
 import sys
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 # Add src directory to Python path
 current_dir = Path(__file__).resolve().parent
@@ -19,11 +20,16 @@ sys.path.insert(0, str(project_root))
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from transformers import set_seed
 from src.training.transformer import CustomTransformer
 from src.training.tokenizer import SimpleTokenizer
+
 # Import the appropriate logger based on the file extension
 from pathlib import Path
 import logging
@@ -66,7 +72,8 @@ class WikipediaDataset(Dataset):
         raw_data_path: Path,
         page_ids: List[str],
         tokenizer: SimpleTokenizer,
-        max_length: int = 512
+        max_length: int = 512,
+        cache_dir: Optional[Path] = None
     ):
         """
         Initialize dataset.
@@ -76,22 +83,54 @@ class WikipediaDataset(Dataset):
             page_ids: List of page IDs to include
             tokenizer: Custom tokenizer
             max_length: Maximum sequence length
+            cache_dir: Directory for the tokenized page cache (defaults to a
+                token_cache directory next to raw_data_path)
         """
         self.raw_data_path = raw_data_path
         self.page_ids = page_ids
         self.tokenizer = tokenizer
         self.max_length = max_length
+        self.cache_dir = Path(cache_dir) if cache_dir else raw_data_path.parent / "token_cache"
+
+        # Tokenize every page once into a flat memory-mapped array; workers
+        # share the mapping through the OS page cache
+        self.data, self.offsets, self.lengths = self._build_cache()
+
     def __len__(self) -> int:
         return len(self.page_ids)
 
-    def __getitem__(self, idx: int) -> Dict[str, List[int]]:
-        """Get tokenized page content."""
-        page_id = self.page_ids[idx]
-        
-        # Ensure page_id is a string, not bytes
-        if isinstance(page_id, bytes):
-            page_id = page_id.decode('utf-8')
-            
+    def _cache_key(self) -> str:
+        """Hash the tokenizer, max_length, page list and page file stats to identify a cache."""
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(self.tokenizer.vocab, sort_keys=True).encode('utf-8'))
+        hasher.update(json.dumps(self.tokenizer.merges).encode('utf-8'))
+        hasher.update(str(self.max_length).encode('utf-8'))
+        # Updated pages are rewritten in place, so key on each file's size and
+        # mtime as well as its ID to rebuild the cache when content changes
+        for page_id in self.page_ids:
+            try:
+                stat = (self.raw_data_path / f"{page_id}.txt").stat()
+                hasher.update(f"{page_id}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+            except FileNotFoundError:
+                hasher.update(f"{page_id}:missing\n".encode('utf-8'))
+        return hasher.hexdigest()[:16]
+
+    @staticmethod
+    def prune_cache(cache_dir: Path, keep_keys: List[str]) -> None:
+        """
+        Delete cached token arrays superseded by the given cache keys.
+
+        Args:
+            cache_dir: Directory holding the tokenized page cache
+            keep_keys: Cache keys still in use
+        """
+        for pattern in ("*.ids.npy", "*.index.npy"):
+            for path in cache_dir.glob(pattern):
+                if path.name.split(".", 1)[0] not in keep_keys:
+                    path.unlink(missing_ok=True)
+
+    def _tokenize_page(self, page_id: str) -> Optional[List[int]]:
+        """Read and tokenize a single page, returning None if its file is missing."""
         file_path = self.raw_data_path / f"{page_id}.txt"
         
         try:
@@ -113,15 +152,129 @@ class WikipediaDataset(Dataset):
                 print(f"First few files in {self.raw_data_path}: {[f.name for f in files]}")
                 print(f"Total files in directory: {len(list(self.raw_data_path.glob('*.txt')))}")
             
-            # Return a minimal set of input_ids to avoid crashing
-            return {"input_ids": [0]}  # Use padding token as fallback
+            return None
 
-        # Tokenize content with BPE-dropout during training (10% dropout probability)
-        tokens = self.tokenizer._tokenize(content, dropout_prob=0.1)[:self.max_length]
-        input_ids = [self.tokenizer._convert_token_to_id(t) for t in tokens]
+        # Tokenize content deterministically so the cached IDs are reproducible
+        tokens = self.tokenizer._tokenize(content)[:self.max_length]
+        return [self.tokenizer._convert_token_to_id(t) for t in tokens]
 
-        # Return raw input_ids for data collator to handle padding
-        return {"input_ids": input_ids}
+    def _build_cache(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Load the tokenized page cache, building it on first use.
+
+        Returns:
+            Tuple of (flat int32 token IDs, per-page offsets, per-page lengths)
+        """
+        self.cache_key = self._cache_key()
+        data_path = self.cache_dir / f"{self.cache_key}.ids.npy"
+        index_path = self.cache_dir / f"{self.cache_key}.index.npy"
+
+        if not (data_path.exists() and index_path.exists()):
+            logger.info(f"Tokenizing {len(self.page_ids)} pages into cache {self.cache_dir}")
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+            all_ids = []
+            index = np.zeros((len(self.page_ids), 2), dtype=np.int64)
+            offset = 0
+            complete = True
+            for i, page_id in enumerate(self.page_ids):
+                input_ids = self._tokenize_page(page_id)
+                if input_ids is None:
+                    # Use padding token as fallback to avoid crashing
+                    input_ids = [0]
+                    complete = False
+                all_ids.extend(input_ids)
+                index[i] = (offset, len(input_ids))
+                offset += len(input_ids)
+            all_ids = np.asarray(all_ids, dtype=np.int32)
+
+            # Never persist fallback tokens; the pages are read again next run
+            if not complete:
+                logger.warning("Some pages could not be read; not caching their tokenized IDs")
+                return all_ids, index[:, 0], index[:, 1]
+
+            # Write to temporary files and rename so concurrent readers never see partial data
+            for path, array in ((data_path, all_ids), (index_path, index)):
+                tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+
+        data = np.load(data_path, mmap_mode='r')
+        index = np.load(index_path)
+        return data, index[:, 0], index[:, 1]
+
+    def __getitem__(self, idx: int) -> Dict[str, Union[int, List[int]]]:
+        """Get tokenized page content."""
+        start = self.offsets[idx]
+        input_ids = self.data[start:start + self.lengths[idx]].tolist()
+
+        # Return raw input_ids for data collator to handle padding, plus the
+        # dataset index so metrics can be mapped back to the page under shuffling
+        return {"input_ids": input_ids, "page_idx": idx}
+
+class CUDAPrefetcher:
+    """Copies the next batch to the device on a side stream while the current batch trains."""
+
+    def __init__(self, loader: DataLoader, device: torch.device, keys: Tuple[str, ...]):
+        """
+        Initialize prefetcher.
+
+        Args:
+            loader: DataLoader yielding dicts of CPU tensors
+            device: Device to copy batches to
+            keys: Batch keys to copy to the device
+        """
+        self.loader = loader
+        self.device = device
+        self.keys = keys
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        """Start copying the next batch to the device."""
+        try:
+            self.next_batch = next(self.iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        if self.stream is None:
+            self.next_device_batch = {k: self.next_batch[k].to(self.device) for k in self.keys}
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_device_batch = {
+                k: self.next_batch[k].to(self.device, non_blocking=True) for k in self.keys
+            }
+
+    def __next__(self) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+        """
+        Get the next batch.
+
+        Returns:
+            Tuple of (CPU batch, device copies of the prefetched keys)
+        """
+        if self.next_batch is None:
+            raise StopIteration
+
+        batch, device_batch = self.next_batch, self.next_device_batch
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # Keep the caching allocator from reusing these buffers while compute still reads them
+            for tensor in device_batch.values():
+                tensor.record_stream(current_stream)
+
+        self.preload()
+        return batch, device_batch
 
 class LLMTrainer:
     """Handles LLM training using Wikipedia data."""
@@ -141,6 +294,9 @@ class LLMTrainer:
         num_heads: int = 4,
         num_layers: int = 4,
         d_ff: int = 512,
+        num_workers: int = 4,
+        compile_model: bool = True,
+        checkpoint_every_epoch: bool = False,
         debug: bool = False
     ):
         """
@@ -161,10 +317,15 @@ class LLMTrainer:
             num_heads: Number of attention heads
             num_layers: Number of transformer layers
             d_ff: Feed-forward dimension
+            num_workers: Number of DataLoader worker processes
+            compile_model: Compile the training forward pass with torch.compile (CUDA only)
+            checkpoint_every_epoch: Write metrics to the changelog after every epoch, not just the last
             debug: Enable debug logging
         """
         self.model_path = model_path
         self.debug = debug
+        # NaN scans force a device sync per check, so they are opt-in via DEBUG_NAN=1
+        self.debug_nan = os.environ.get("DEBUG_NAN", "0") == "1"
         self.changelog = get_appropriate_logger(changelog_path, debug=debug)
         self.raw_data_path = Path(raw_data_path)
         self.output_dir = Path(output_dir)
@@ -177,6 +338,17 @@ class LLMTrainer:
         self.num_heads = num_heads
         self.num_layers = num_layers
         self.d_ff = d_ff
+        self.num_workers = num_workers
+        self.checkpoint_every_epoch = checkpoint_every_epoch
+
+        # Distributed setup (process group is initialized by main() under torchrun)
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        if torch.cuda.is_available():
+            self.device = torch.device("cuda", self.local_rank)
+        else:
+            self.device = torch.device("cpu")
 
         # Set random seed
         set_seed(seed)
@@ -227,6 +399,9 @@ class LLMTrainer:
             except Exception as e:
                 raise ValueError(f"Error loading pre-trained tokenizer: {str(e)}")
 
+        # Cache the padding token ID (used for padding and as the loss ignore_index)
+        self.pad_id = self.tokenizer._convert_token_to_id(self.tokenizer.pad_token)
+
         # Load or initialize model
         if model_dir and model_dir.exists() and (model_dir / "config.json").exists():
             # Load model
@@ -258,6 +433,28 @@ class LLMTrainer:
                 d_ff=self.d_ff,
                 max_seq_length=self.max_length
             )
+
+        # Move model to the training device
+        logger.info(f"Using device: {self.device}")
+        self.model.to(self.device)
+
+        # Wrap for data-parallel training; gradients are all-reduced in buckets during backward
+        self.train_model = self.model
+        if self.distributed:
+            self.train_model = DDP(
+                self.model,
+                device_ids=[self.local_rank] if self.device.type == "cuda" else None,
+                bucket_cap_mb=25,
+                gradient_as_bucket_view=True
+            )
+
+        # Compile the training forward pass. CUDA graphs need static shapes,
+        # so batches are padded to fixed length buckets whenever the model is compiled.
+        self.static_padding = False
+        if compile_model and self.device.type == "cuda" and hasattr(torch, "compile"):
+            logger.info("Compiling model with torch.compile (inductor, reduce-overhead)")
+            self.train_model = torch.compile(self.train_model, backend="inductor", mode="reduce-overhead")
+            self.static_padding = True
     
     # Removed _train_new_tokenizer method as tokenizer training is now a separate process
 
@@ -266,32 +463,60 @@ class LLMTrainer:
         state_dict = self.model.state_dict()
         hasher = hashlib.sha256()
         
-        # Sort keys for consistent ordering
+        # Sort keys for consistent ordering; feed each tensor's buffer directly
+        # (no intermediate bytes copy) so OpenSSL can hash it in one pass
         for key in sorted(state_dict.keys()):
-            hasher.update(state_dict[key].cpu().numpy().tobytes())
+            tensor = state_dict[key].detach().contiguous().cpu().reshape(-1)
+            hasher.update(memoryview(tensor.numpy()).cast("B"))
         
         return hasher.hexdigest()
 
-    def _collate_fn(self, examples: List[Dict[str, List[int]]]) -> Dict[str, torch.Tensor]:
+    def _clip_gradients(self, max_norm: torch.Tensor) -> torch.Tensor:
+        """
+        Clip gradients to a global L2 norm without a host sync.
+
+        Equivalent to torch.nn.utils.clip_grad_norm_ with foreach=True, but
+        accepts max_norm as a device tensor.
+
+        Args:
+            max_norm: Scalar tensor with the maximum gradient norm
+
+        Returns:
+            Total gradient norm before clipping
+        """
+        grads = [p.grad for p in self.model.parameters() if p.grad is not None]
+        if not grads:
+            return torch.zeros((), device=self.device)
+
+        total_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads)))
+        clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+        torch._foreach_mul_(grads, clip_coef)
+        return total_norm
+
+    def _collate_fn(self, examples: List[Dict[str, Union[int, List[int]]]]) -> Dict[str, torch.Tensor]:
         """Custom collate function for batching."""
         # Get all input_ids
-        input_ids = [example["input_ids"] for example in examples]
+        sequences = [torch.as_tensor(example["input_ids"], dtype=torch.long) for example in examples]
+        lengths = torch.tensor([len(seq) for seq in sequences])
+        
+        # Pad to the longest sequence in the batch
+        padded_input_ids = pad_sequence(sequences, batch_first=True, padding_value=self.pad_id)
+        max_len = padded_input_ids.size(1)
         
-        # Find max length in batch
-        max_len = max(len(ids) for ids in input_ids)
+        # Compiled models see a handful of fixed shapes: round up to a power-of-two bucket
+        if self.static_padding:
+            bucket_len = min(self.max_length, 1 << max(0, max_len - 1).bit_length())
+            if bucket_len > max_len:
+                padded_input_ids = F.pad(padded_input_ids, (0, bucket_len - max_len), value=self.pad_id)
+                max_len = bucket_len
         
-        # Pad input_ids and create attention masks
-        padded_input_ids = []
-        attention_mask = []
-        for ids in input_ids:
-            padding_length = max_len - len(ids)
-            padded_input_ids.append(ids + [self.tokenizer._convert_token_to_id(self.tokenizer.pad_token)] * padding_length)
-            attention_mask.append([1] * len(ids) + [0] * padding_length)
+        # Attention mask from sequence lengths (a real token may share the pad ID)
+        attention_mask = (torch.arange(max_len).unsqueeze(0) < lengths.unsqueeze(1)).long()
         
-        # Convert to tensors
         batch = {
-            "input_ids": torch.tensor(padded_input_ids),
-            "attention_mask": torch.tensor(attention_mask)
+            "input_ids": padded_input_ids,
+            "attention_mask": attention_mask,
+            "page_idx": torch.tensor([example["page_idx"] for example in examples])
         }
         
         return batch
@@ -322,10 +547,6 @@ class LLMTrainer:
         # Filter out page IDs that don't have corresponding files in raw_data_path
         existing_page_ids = []
         for page_id in page_ids:
-            # Ensure page_id is a string, not bytes
-            if isinstance(page_id, bytes):
-                page_id = page_id.decode('utf-8')
-                
             file_path = self.raw_data_path / f"{page_id}.txt"
             if file_path.exists():
                 existing_page_ids.append(page_id)
@@ -343,8 +564,10 @@ class LLMTrainer:
         # Use only existing page IDs
         page_ids = existing_page_ids
 
-        # Split into train/val
-        np.random.shuffle(page_ids)
+        # Split into train/val (permute integer indices rather than shuffling the
+        # object list; seeded so every rank derives the same split)
+        rng = np.random.default_rng(self.seed)
+        page_ids = [page_ids[i] for i in rng.permutation(len(page_ids)).tolist()]
         split_idx = int(len(page_ids) * (1 - val_split))
         train_ids = page_ids[:split_idx]
         val_ids = page_ids[split_idx:]
@@ -365,190 +588,179 @@ class LLMTrainer:
             self.tokenizer,
             self.max_length
         )
+        if self.rank == 0:
+            WikipediaDataset.prune_cache(train_dataset.cache_dir, [train_dataset.cache_key, val_dataset.cache_key])
 
         # Create output directory
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
-        # Create data loaders
+        # Create data loaders (pinned memory lets host->device copies run asynchronously)
+        loader_kwargs = {
+            "batch_size": self.batch_size,
+            "collate_fn": self._collate_fn,
+            "num_workers": self.num_workers,
+            "pin_memory": self.device.type == "cuda"
+        }
+        if self.num_workers > 0:
+            loader_kwargs["persistent_workers"] = True
+            loader_kwargs["prefetch_factor"] = 4
+        # Each rank sees a disjoint shard of the training pages
+        train_sampler = DistributedSampler(train_dataset, shuffle=True) if self.distributed else None
         train_loader = DataLoader(
             train_dataset,
-            batch_size=self.batch_size,
-            shuffle=True,
-            collate_fn=self._collate_fn
+            shuffle=train_sampler is None,
+            sampler=train_sampler,
+            **loader_kwargs
         )
         val_loader = DataLoader(
             val_dataset,
-            batch_size=self.batch_size,
             shuffle=False,
-            collate_fn=self._collate_fn
+            **loader_kwargs
         )
 
         # Setup optimizer
+        # Fused AdamW updates every parameter in a single kernel on CUDA
+        optimizer_kwargs = {"fused": True} if self.device.type == "cuda" else {"foreach": True}
         optimizer = torch.optim.AdamW(
             self.model.parameters(),
             lr=self.learning_rate,
             betas=(0.9, 0.999),
             eps=1e-8,
-            weight_decay=0.01
+            weight_decay=0.01,
+            **optimizer_kwargs
         )
 
+        # Mixed precision: BF16 where supported, otherwise FP16 with loss scaling
+        use_amp = self.device.type == "cuda"
+        if use_amp:
+            # Allow TF32 tensor cores for the float32 matmuls left outside autocast
+            torch.set_float32_matmul_precision('high')
+        if use_amp and torch.cuda.is_bf16_supported():
+            amp_dtype = torch.bfloat16
+        else:
+            amp_dtype = torch.float16
+        use_scaler = use_amp and amp_dtype == torch.float16
+        # torch.amp.GradScaler only exists from torch 2.3; requirements allow 2.1
+        if hasattr(torch.amp, "GradScaler"):
+            scaler = torch.amp.GradScaler("cuda", enabled=use_scaler)
+        else:
+            scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+
+        # Per-page metrics, indexed by position in train_ids and accumulated in
+        # preallocated tensors; only formatted into dicts at the end of each epoch
+        training_metrics = {
+            "initial_loss": torch.full((len(train_ids),), float("nan")),
+            "loss_sum": torch.zeros(len(train_ids)),
+            "loss_count": torch.zeros(len(train_ids)),
+            "token_impact": {}
+        }
+        saved_loss_count = torch.zeros(len(train_ids))
+
         # Training loop
         self.model.train()
         for epoch in range(self.num_epochs):
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
             total_loss = 0
-            for batch_idx, batch in enumerate(train_loader):
-                input_ids = batch["input_ids"]
-                attention_mask = batch["attention_mask"]
-                labels = input_ids.clone()
-
-                # Initialize metrics dictionary at the start of training
-                if epoch == 0 and batch_idx == 0:
-                    training_metrics = {}
-                    # Calculate initial loss for all pages
-                    with torch.no_grad():
-                        initial_logits = self.model(x=input_ids, attention_mask=attention_mask)
-                        initial_loss = F.cross_entropy(
-                            initial_logits.view(-1, initial_logits.size(-1)),
-                            labels.view(-1),
-                            ignore_index=self.tokenizer._convert_token_to_id(self.tokenizer.pad_token),
-                            reduction='none'
-                        )
-                        initial_token_loss = initial_loss.view(input_ids.shape)
-                        initial_sequence_loss = initial_token_loss.sum(dim=1) / (attention_mask.sum(dim=1).float() + 1e-8)
-                        initial_loss_value = initial_sequence_loss[0].item()
-                        
-                        for page_id in train_ids:
-                            training_metrics[page_id] = {
-                                "initial_loss": initial_loss_value,
-                                "average_loss": [],
-                                "token_impact": []
-                            }
-                
-                if torch.isnan(input_ids).any():
-                    print(f"⚠️ NaN detected in input_ids at Epoch {epoch}, Batch {batch_idx}!")
-                
-                if torch.isnan(attention_mask).any():
-                    print(f"⚠️ NaN detected in attention_mask at Epoch {epoch}, Batch {batch_idx}!")
-                
-                # Forward pass with metrics collection
-                logits = self.model(x=input_ids, attention_mask=attention_mask, store_metrics=True)
-
-                # debug: chekc if logits contain NaN
-                if torch.isnan(logits).any():
-                    print(f"⚠️ NaN detected in logits at Epoch {epoch}, Batch {batch_idx}!")
-                    print(f"Max logit value: {torch.max(logits).item()}")
-                    print(f"Min logit value: {torch.min(logits).item()}")
-
-                # Normalize lgoits to prevent NaN issues with minimal impact
-                logits = logits - logits.max(dim=-1,keepdim=True).values
-                logits = torch.clamp(logits, min=-10, max=10)  # Clip extreme values
-                
-                # Debug: Check for NaN in logits before computing loss
-                if torch.isnan(logits).any():
-                    print(f"⚠️ NaN detected in logits BEFORE loss at Epoch {epoch}, Batch {batch_idx}!")
-                    print(f"Max logit value: {torch.max(logits).item()}")
-                    print(f"Min logit value: {torch.min(logits).item()}")
-                
-                # Calculate loss
-                loss = F.cross_entropy(
-                    logits.view(-1, logits.size(-1)),
-                    labels.view(-1),
-                    ignore_index=self.tokenizer._convert_token_to_id(self.tokenizer.pad_token),
-                    reduction='none'
-                )
+            # Overlap host-to-device copies of the next batch with compute on the current one
+            prefetcher = CUDAPrefetcher(train_loader, self.device, keys=("input_ids", "attention_mask"))
+            for batch_idx, (batch, device_batch) in enumerate(prefetcher):
+                # Drop gradients from the previous step (no per-parameter memset)
+                optimizer.zero_grad(set_to_none=True)
+
+                input_ids = device_batch["input_ids"]
+                attention_mask = device_batch["attention_mask"]
+
+                # Mixed-precision forward pass and loss
+                with torch.autocast(device_type=self.device.type, dtype=amp_dtype, enabled=use_amp):
+                    # Forward pass with metrics collection
+                    logits = self.train_model(x=input_ids, attention_mask=attention_mask, store_metrics=True)
+
+                    # debug: check if logits contain NaN
+                    if self.debug_nan and torch.isnan(logits).any():
+                        print(f"⚠️ NaN detected in logits at Epoch {epoch}, Batch {batch_idx}!")
+                        print(f"Max logit value: {torch.max(logits).item()}")
+                        print(f"Min logit value: {torch.min(logits).item()}")
+
+                    # Causal LM objective: logits at position t predict the token at t+1
+                    shift_logits = logits[:, :-1, :]
+                    shift_labels = input_ids[:, 1:]
+                    
+                    # Calculate loss (cross_entropy applies a numerically stable log-softmax,
+                    # so the raw logits are passed straight through)
+                    loss = F.cross_entropy(
+                        shift_logits.reshape(-1, shift_logits.size(-1)),
+                        shift_labels.reshape(-1),
+                        ignore_index=self.pad_id,
+                        reduction='none'
+                    )
 
-                # debug: check if loss contains NaN
-                if torch.isnan(loss).any():
-                    print(f"⚠️ NaN detected in loss at Epoch {epoch}, Batch {batch_idx}!")
+                    # debug: check if loss contains NaN
+                    if self.debug_nan and torch.isnan(loss).any():
+                        print(f"⚠️ NaN detected in loss at Epoch {epoch}, Batch {batch_idx}!")
                 
-                # Reshape loss to match input shape for per-token metrics
-                token_loss = loss.view(input_ids.shape)
+                    # Reshape loss to match the shifted label shape for per-token metrics
+                    token_loss = loss.view(shift_labels.shape)
                 
-                # Calculate relative loss for each sequence in batch
-                #sequence_loss = token_loss.sum(dim=1) / (attention_mask.sum(dim=1).float() + 1e-8)
-                sequence_loss = token_loss.sum(dim=1) / torch.clamp(attention_mask.sum(dim=1).float(),min=1)
-                batch_loss = sequence_loss.mean()
+                    # Calculate relative loss for each sequence in batch
+                    sequence_loss = token_loss.sum(dim=1) / torch.clamp(attention_mask[:, 1:].sum(dim=1).float(), min=1)
+                    batch_loss = sequence_loss.mean()
                 
-                # Store metrics for each sequence
-                start_idx = batch_idx * self.batch_size
-                end_idx = min((batch_idx + 1) * self.batch_size, len(train_ids))
-                batch_page_ids = train_ids[start_idx:end_idx]
+                # Update per-page loss accumulators for the current batch
+                page_idx = batch["page_idx"]
+                sequence_loss_cpu = sequence_loss.detach().float().cpu()
                 
-                # Update metrics for current batch
-                for idx, page_id in enumerate(batch_page_ids):
-                    if page_id not in training_metrics:
-                        # Calculate initial loss for relative loss metric
-                        with torch.no_grad():
-                            initial_logits = self.model(x=input_ids, attention_mask=attention_mask)
-                            initial_loss = F.cross_entropy(
-                                initial_logits.view(-1, initial_logits.size(-1)),
-                                labels.view(-1),
-                                ignore_index=self.tokenizer._convert_token_to_id(self.tokenizer.pad_token),
-                                reduction='none'
-                            )
-                            initial_token_loss = initial_loss.view(input_ids.shape)
-                            initial_sequence_loss = initial_token_loss.sum(dim=1) / (attention_mask.sum(dim=1).float() + 1e-8)
-
-                        training_metrics[page_id] = {
-                            "initial_loss": initial_sequence_loss[idx].item(),
-                            "average_loss": [],
-                            "token_impact": []
-                        }
+                # First visit: this batch's loss is computed before the optimizer
+                # step, so it is the page's initial loss for the relative loss metric
+                first_visit = torch.isnan(training_metrics["initial_loss"][page_idx])
+                training_metrics["initial_loss"][page_idx[first_visit]] = sequence_loss_cpu[first_visit]
+                training_metrics["loss_sum"].index_add_(0, page_idx, sequence_loss_cpu)
+                training_metrics["loss_count"].index_add_(0, page_idx, torch.ones_like(sequence_loss_cpu))
+                
+                # Store token impact if available
+                token_impacts = self.model.get_token_impacts()
+                if token_impacts is not None:
+                    impact_values = token_impacts.detach().float().reshape(input_ids.size(0), -1)
+                    abs_impacts = impact_values.abs()
+                    
+                    # Calculate significance thresholds (95th percentile) for the whole batch on device
+                    thresholds = torch.quantile(abs_impacts, 0.95, dim=1, keepdim=True, interpolation="higher")
                     
-                    # Store average loss
-                    training_metrics[page_id]["average_loss"].append(sequence_loss[idx].item())
+                    # Copy impacts and critical-token masks to the host once per batch;
+                    # token IDs come from the CPU batch, which needs no transfer
+                    impacts_cpu = impact_values.cpu().numpy()
+                    critical_cpu = (abs_impacts >= thresholds).cpu().numpy()
+                    tokens_cpu = batch["input_ids"].numpy()
                     
-                    # Store token impact if available
-                    token_impacts = self.model.get_token_impacts()
-                    if token_impacts is not None:
-                        # Get token IDs and impact values for this sequence
-                        sequence_tokens = input_ids[idx].cpu().numpy()
-                        impact_values = token_impacts[idx].detach().cpu().numpy().flatten()
-                        
-                        # Store token impacts with context
-                        sequence_tokens = sequence_tokens.tolist()
-                        impact_values = impact_values.tolist()
-                        
-                        # Calculate significance threshold (95th percentile)
-                        abs_impacts = [abs(x) for x in impact_values]
-                        threshold = sorted(abs_impacts)[int(len(abs_impacts) * 0.95)]
-                        
-                        # Find critical tokens with context
-                        critical_tokens = []
-                        context_window = 2  # tokens before and after
-                        
-                        for i, (token_id, impact) in enumerate(zip(sequence_tokens, impact_values)):
-                            if abs(impact) >= threshold:
-                                start_pos = max(0, i - context_window)
-                                end_pos = min(len(sequence_tokens), i + context_window + 1)
-                                critical_tokens.append({
-                                    "token_id": token_id,
-                                    "position": i,
-                                    "impact": float(impact),
-                                    "context": [start_pos, end_pos]
-                                })
-                        
-                        training_metrics[page_id]["token_impact"].append({
-                            "critical_tokens": critical_tokens,
-                            "impact_threshold": float(threshold),
-                            "total_tokens": len(sequence_tokens)
-                        })
-
-                # Backward pass
-                batch_loss.backward()
-
-                # debug: check if gradients contain NaN
-                for name, param in self.model.named_parameters():
-                    if param.grad is not None and torch.isnan(param.grad).any():
-                        print(f"⚠️ NaN detected in gradients of {name} at Epoch {epoch}, Batch {batch_idx}!")
-
-                # Adaptive gradient clipping (Prevents extreme updates while allowing learning)
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=max(0.5,0.1 * batch_loss.item()))
+                    # Only the latest values per page are kept
+                    for idx, page_index in enumerate(page_idx.tolist()):
+                        positions = np.flatnonzero(critical_cpu[idx])
+                        training_metrics["token_impact"][page_index] = (
+                            positions,
+                            tokens_cpu[idx, positions],
+                            impacts_cpu[idx, positions],
+                            impacts_cpu.shape[1]
+                        )
+
+                # Backward pass (loss scaling is a no-op unless training in FP16)
+                scaler.scale(batch_loss).backward()
+                scaler.unscale_(optimizer)
+
+                # debug: check if gradients contain NaN (sampled, since it syncs per parameter)
+                if self.debug_nan and batch_idx % 100 == 0:
+                    for name, param in self.model.named_parameters():
+                        if param.grad is not None and torch.isnan(param.grad).any():
+                            print(f"⚠️ NaN detected in gradients of {name} at Epoch {epoch}, Batch {batch_idx}!")
+
+                # Adaptive gradient clipping (Prevents extreme updates while allowing learning);
+                # the threshold stays on device so backward -> step never syncs
+                clip_norm = torch.clamp(0.1 * batch_loss.detach().float(), min=0.5)
+                self._clip_gradients(clip_norm)
                 
-                optimizer.step()
-                optimizer.zero_grad()
+                scaler.step(optimizer)
+                scaler.update()
 
-                total_loss += batch_loss.item()
+                total_loss += batch_loss.detach()
 
                 if batch_idx % 10 == 0:
                     logger.info(
@@ -557,28 +769,59 @@ class LLMTrainer:
                         f"Loss: {batch_loss.item():.4f}"
                     )
 
-            avg_loss = total_loss / len(train_loader)
+            avg_loss = float(total_loss) / len(train_loader)
             logger.info(f"Epoch {epoch+1} average loss: {avg_loss:.4f}")
 
-            # Save intermediate metrics after each epoch
+            # Save metrics after the final epoch (or every epoch when checkpointing)
+            final_epoch = epoch == self.num_epochs - 1
+            if not (final_epoch or self.checkpoint_every_epoch):
+                continue
+
+            epoch_metrics = self._gather_training_metrics(training_metrics)
+            if self.rank != 0:
+                continue
+
             checkpoint_hash = self._compute_checkpoint_hash()
+            loss_count = epoch_metrics["loss_count"]
+            average_losses = (epoch_metrics["loss_sum"] / loss_count.clamp(min=1)).tolist()
+            initial_losses = epoch_metrics["initial_loss"].tolist()
+            context_window = 2  # tokens before and after
+            
+            # Only rebuild metrics for pages trained on since the last save
+            dirty_pages = (loss_count != saved_loss_count).nonzero(as_tuple=True)[0].tolist()
+            saved_loss_count = loss_count.clone()
+            
             intermediate_metrics = {}
-            for page_id, metrics in training_metrics.items():
+            for page_idx in dirty_pages:
+                page_id = train_ids[page_idx]
+                
                 # Calculate average loss and relative loss
-                avg_loss = sum(metrics["average_loss"]) / len(metrics["average_loss"])
-                rel_loss = (metrics["initial_loss"] - avg_loss) / metrics["initial_loss"]
+                avg_loss = average_losses[page_idx]
+                initial_loss = initial_losses[page_idx]
+                # Pages with fewer than two tokens have no targets, so their loss
+                # is exactly 0; report no relative change rather than divide by it
+                if initial_loss == 0 or math.isnan(initial_loss):
+                    rel_loss = 0.0
+                else:
+                    rel_loss = (initial_loss - avg_loss) / initial_loss
                 
-                # For token impact, use the last epoch's values and format correctly for db_utils.mark_used_in_training
+                # For token impact, use the latest values and format correctly for db_utils.mark_used_in_training
                 token_impact = None
-                if metrics["token_impact"] and len(metrics["token_impact"]) > 0:
-                    # Get the last epoch's token impact data
-                    last_impact = metrics["token_impact"][-1]
+                if page_idx in epoch_metrics["token_impact"]:
+                    positions, token_ids, impacts, total_tokens = epoch_metrics["token_impact"][page_idx]
                     
                     # Format token impact data correctly for machine unlearning experiments
-                    # The db_utils.mark_used_in_training function expects "top_tokens" instead of "critical_tokens"
                     token_impact = {
-                        "top_tokens": last_impact["critical_tokens"],  # Rename critical_tokens to top_tokens
-                        "total_tokens": last_impact["total_tokens"]
+                        "top_tokens": [
+                            {
+                                "token_id": token_id,
+                                "position": i,
+                                "impact": impact,
+                                "context": [max(0, i - context_window), min(total_tokens, i + context_window + 1)]
+                            }
+                            for i, token_id, impact in zip(positions.tolist(), token_ids.tolist(), impacts.tolist())
+                        ],
+                        "total_tokens": total_tokens
                     }
                     
                     # Always log the token impact data for debugging
@@ -587,8 +830,8 @@ class LLMTrainer:
                 
                 # Only include metrics if we have valid values
                 metrics_dict = {
-                    "average_loss": float(avg_loss),
-                    "relative_loss": float(rel_loss)
+                    "average_loss": avg_loss,
+                    "relative_loss": rel_loss
                 }
                 
                 if token_impact is not None:
@@ -596,14 +839,20 @@ class LLMTrainer:
                 
                 intermediate_metrics[page_id] = metrics_dict
 
-            logger.info(f"Saving intermediate metrics for epoch {epoch+1}...")
+            logger.info(f"Saving metrics for {len(intermediate_metrics)} pages after epoch {epoch+1}...")
             try:
-                # Only mark training pages as used, since we only have metrics for them
-                self.changelog.mark_used_in_training(train_ids, checkpoint_hash, intermediate_metrics)
+                # Only mark training pages as used, since we only have metrics for them;
+                # intermediate checkpoints touch just the pages updated since the last save
+                marked_page_ids = train_ids if final_epoch else list(intermediate_metrics)
+                self.changelog.mark_used_in_training(marked_page_ids, checkpoint_hash, intermediate_metrics)
                 logger.info(f"Successfully saved metrics for epoch {epoch+1}")
             except Exception as e:
                 logger.error(f"Failed to save intermediate metrics: {str(e)}")
 
+        # Only the main process writes the model and updates the changelog
+        if self.rank != 0:
+            return
+
         # Save final model
         final_output_dir = self.output_dir / "final"
         self.model.save_pretrained(final_output_dir)
@@ -622,6 +871,36 @@ class LLMTrainer:
         self.changelog.remove_unused_entries()
         logger.info("Unused entries removed")
 
+    def _gather_training_metrics(self, training_metrics: Dict) -> Dict:
+        """
+        Collect per-page training metrics from all ranks onto rank 0.
+
+        Args:
+            training_metrics: Metric accumulators recorded by this process
+
+        Returns:
+            Accumulators merged across ranks on rank 0, an empty dict on other ranks
+        """
+        if not self.distributed:
+            return training_metrics
+
+        gathered = [None] * dist.get_world_size() if self.rank == 0 else None
+        dist.gather_object(training_metrics, gathered, dst=0)
+        if self.rank != 0:
+            return {}
+
+        merged = {
+            "initial_loss": gathered[0]["initial_loss"].clone(),
+            "loss_sum": sum(rank_metrics["loss_sum"] for rank_metrics in gathered),
+            "loss_count": sum(rank_metrics["loss_count"] for rank_metrics in gathered),
+            "token_impact": {}
+        }
+        for rank_metrics in gathered:
+            missing = torch.isnan(merged["initial_loss"])
+            merged["initial_loss"][missing] = rank_metrics["initial_loss"][missing]
+            merged["token_impact"].update(rank_metrics["token_impact"])
+        return merged
+
     def generate_text(
         self,
         prompt: str,
@@ -640,7 +919,7 @@ class LLMTrainer:
             max_length=self.max_length,
             return_tensors="pt",
             dropout_prob=0.0  # Ensure no dropout during inference
-        )
+        ).to(self.device)
         
         # Generate text using custom model
         output_ids = self.model.generate(
@@ -751,6 +1030,22 @@ def main():
         default=100,
         help="Minimum number of pages required"
     )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=4,
+        help="Number of DataLoader worker processes"
+    )
+    parser.add_argument(
+        "--checkpoint-every-epoch",
+        action="store_true",
+        help="Write training metrics to the changelog after every epoch"
+    )
+    parser.add_argument(
+        "--no-compile",
+        action="store_true",
+        help="Disable torch.compile for the training forward pass"
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -759,6 +1054,12 @@ def main():
     # Removed retrain-tokenizer parameter as tokenizer training is now a separate process
     args = parser.parse_args()
 
+    # Join the process group when launched with torchrun
+    if int(os.environ.get("WORLD_SIZE", "1")) > 1:
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+        dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
+
     if args.load_model:
         # Load and test model
         trainer = load_model(args.load_model, debug=args.debug)
@@ -778,6 +1079,9 @@ def main():
             num_heads=args.num_heads,
             num_layers=args.num_layers,
             d_ff=args.d_ff,
+            num_workers=args.num_workers,
+            compile_model=not args.no_compile,
+            checkpoint_every_epoch=args.checkpoint_every_epoch,
             debug=args.debug
         )
 
@@ -786,5 +1090,8 @@ def main():
             min_pages=args.min_pages
         )
 
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
 if __name__ == "__main__":
     main()
@@ -67,8 +67,6 @@ def train_tokenizer(
     texts = []
     for entry in all_pages:
         page_id = entry["page_id"]
-        if isinstance(page_id, bytes):
-            page_id = page_id.decode("utf-8")
         file_path = raw_data_path / f"{page_id}.txt"
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
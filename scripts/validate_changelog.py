@@ -184,8 +184,7 @@ def validate_db_schema(db_path: str) -> bool:
         "idx_entries_page_id",
         "idx_entries_parent_id",
         "idx_training_metadata_entry_id",
-        "idx_token_impacts_metadata_id",
-        "idx_top_tokens_token_impact_id"
+        "idx_token_impacts_metadata_id"
     ]
     
     for index in required_indices:
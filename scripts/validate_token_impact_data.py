@@ -14,54 +14,244 @@ import os
 from pathlib import Path
 import json
 import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Add src directory to Python path
 current_dir = Path(__file__).resolve().parent
 project_root = current_dir.parent
 sys.path.insert(0, str(project_root))
 
+from src.db.db_schema import close_db
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Queries are built once at import so repeated runs reuse sqlite3's statement cache
+TABLE_EXISTS_QUERY = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+
+COVERAGE_QUERY = """
+SELECT
+    COUNT(DISTINCT CASE WHEN tm.id IS NULL THEN ti.id END),
+    (SELECT COUNT(*) FROM top_tokens o
+     WHERE NOT EXISTS (SELECT 1 FROM token_impacts i WHERE i.id = o.token_impact_id)),
+    COUNT(DISTINCT e.page_id),
+    COUNT(DISTINCT CASE WHEN tt.token_impact_id IS NOT NULL THEN e.page_id END)
+FROM token_impacts ti
+LEFT JOIN training_metadata tm ON ti.metadata_id = tm.id
+LEFT JOIN entries e ON e.id = tm.entry_id
+LEFT JOIN top_tokens tt ON tt.token_impact_id = ti.id
+"""
+
+COVERAGE_QUERY_NO_TOP_TOKENS = """
+SELECT
+    COUNT(CASE WHEN tm.id IS NULL THEN 1 END),
+    COUNT(DISTINCT e.page_id)
+FROM token_impacts ti
+LEFT JOIN training_metadata tm ON ti.metadata_id = tm.id
+LEFT JOIN entries e ON e.id = tm.entry_id
+"""
+
+# Boolean form of the coverage checks; each EXISTS stops at the first matching row
+VALIDATION_QUERY = """
+SELECT
+    EXISTS (SELECT 1 FROM token_impacts ti
+            WHERE NOT EXISTS (SELECT 1 FROM training_metadata tm WHERE tm.id = ti.metadata_id)),
+    EXISTS (SELECT 1 FROM top_tokens tt
+            WHERE NOT EXISTS (SELECT 1 FROM token_impacts ti WHERE ti.id = tt.token_impact_id)),
+    EXISTS (SELECT 1 FROM token_impacts ti
+            JOIN training_metadata tm ON tm.id = ti.metadata_id
+            JOIN entries e ON e.id = tm.entry_id),
+    EXISTS (SELECT 1 FROM top_tokens tt
+            JOIN token_impacts ti ON ti.id = tt.token_impact_id
+            JOIN training_metadata tm ON tm.id = ti.metadata_id
+            JOIN entries e ON e.id = tm.entry_id)
+"""
+
+EXPORT_QUERY = """
+SELECT e.page_id, e.title, ti.id as token_impact_id, ti.total_tokens,
+       tt.token_id, tt.position, tt.impact, tt.context_start, tt.context_end
+FROM entries e
+JOIN training_metadata tm ON e.id = tm.entry_id
+JOIN token_impacts ti ON tm.id = ti.metadata_id
+LEFT JOIN top_tokens tt ON tt.token_impact_id = ti.id
+ORDER BY ti.id
+"""
+
 def get_db_connection(db_path):
-    """Create and return a connection to the SQLite database."""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    """Create and return a read-only connection to the SQLite database."""
+    # Plain read-only mode (not immutable) so readers still see WAL content
+    # that writers have committed but not yet checkpointed
+    db_uri = f"{Path(db_path).resolve().as_uri()}?mode=ro"
+    conn = sqlite3.connect(db_uri, uri=True, cached_statements=256)
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -65536")
+    conn.execute("PRAGMA mmap_size = 268435456")
     return conn
 
+def rows_to_dicts(cursor, batch_size=1000):
+    """Yield the cursor's remaining rows as dicts, fetching them in bounded batches."""
+    # Look up column names once rather than per row
+    keys = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(zip(keys, row))
+
 def check_table_exists(conn, table_name):
     """Check if a table exists in the database."""
     cursor = conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+    cursor.execute(TABLE_EXISTS_QUERY, (table_name,))
     return cursor.fetchone() is not None
 
-def get_table_schema(conn, table_name):
-    """Get the schema of a table."""
+def get_table_pragma(conn, pragma, table_names):
+    """
+    Run a table PRAGMA (e.g. table_info) for several tables in a single query.
+    
+    Args:
+        conn: Database connection
+        pragma: Name of a table-valued PRAGMA function without the pragma_ prefix
+        table_names: Tables to introspect
+    
+    Returns:
+        dict: PRAGMA rows as dicts, keyed by table name
+    """
     cursor = conn.cursor()
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    return cursor.fetchall()
+    placeholders = ", ".join("?" for _ in table_names)
+    cursor.execute(f"""
+        SELECT m.name AS table_name, p.*
+        FROM sqlite_master m, pragma_{pragma}(m.name) p
+        WHERE m.type = 'table' AND m.name IN ({placeholders})
+    """, tuple(table_names))
+    
+    results = {name: [] for name in table_names}
+    for row in rows_to_dicts(cursor):
+        results[row.pop("table_name")].append(row)
+    return results
 
-def get_table_count(conn, table_name):
-    """Get the number of rows in a table."""
+def get_cached_counts(conn, table_names):
+    """
+    Get row counts from the trigger-maintained _counts table.
+    
+    Args:
+        conn: Database connection
+        table_names: Tables to look up
+    
+    Returns:
+        dict: Row counts for the tables whose count triggers are installed
+    """
     cursor = conn.cursor()
-    cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-    return cursor.fetchone()[0]
+    placeholders = ", ".join("?" for _ in table_names)
+    try:
+        # Only trust counts that a trigger keeps up to date
+        cursor.execute(f"""
+            SELECT c.table_name, c.n FROM _counts c
+            WHERE c.table_name IN ({placeholders})
+            AND EXISTS (
+                SELECT 1 FROM sqlite_master
+                WHERE type = 'trigger' AND name = c.table_name || '_count_insert'
+            )
+        """, tuple(table_names))
+    except sqlite3.OperationalError:
+        # Database predates the _counts table
+        return {}
+    return dict(cursor.fetchall())
 
-def get_token_impact_stats(db_path="data/changelog.db"):
+def get_table_counts(conn, table_names):
+    """Get the number of rows in each table, counting only tables missing from the cache."""
+    counts = get_cached_counts(conn, table_names)
+    missing = [name for name in table_names if name not in counts]
+    if missing:
+        cursor = conn.cursor()
+        cursor.execute("SELECT " + ", ".join(f"(SELECT COUNT(*) FROM {name})" for name in missing))
+        counts.update(zip(missing, cursor.fetchone()))
+    return {name: counts[name] for name in table_names}
+
+def get_sample_data(conn, table_names):
+    """Get the first rows of each table, encoded as JSON by SQLite in a single query."""
+    if not table_names:
+        return {}
+    
+    columns = get_table_pragma(conn, "table_info", table_names)
+    selects = []
+    for table in table_names:
+        fields = ", ".join(f"'{column['name']}', \"{column['name']}\"" for column in columns[table])
+        selects.append(f"(SELECT json_group_array(json_object({fields})) FROM (SELECT * FROM {table} LIMIT 5))")
+    
+    cursor = conn.cursor()
+    cursor.execute("SELECT " + ", ".join(selects))
+    return {table: json.loads(value) for table, value in zip(table_names, cursor.fetchone())}
+
+def get_coverage_stats(conn, top_tokens_exists):
+    """
+    Count orphaned records and pages with token impact data in a single pass
+    over token_impacts instead of repeating the entries join per statistic.
+    
+    Args:
+        conn: Database connection
+        top_tokens_exists: Whether the top_tokens table exists
+    
+    Returns:
+        dict: Orphan counts and page coverage statistics
+    """
+    cursor = conn.cursor()
+    if top_tokens_exists:
+        cursor.execute(COVERAGE_QUERY)
+        orphan_ti, orphan_tt, pages_ti, pages_tt = cursor.fetchone()
+        return {
+            "orphaned": {"token_impacts": orphan_ti, "top_tokens": orphan_tt},
+            "pages_with_token_impacts": pages_ti,
+            "pages_with_top_tokens": pages_tt
+        }
+    
+    cursor.execute(COVERAGE_QUERY_NO_TOP_TOKENS)
+    orphan_ti, pages_ti = cursor.fetchone()
+    return {
+        "orphaned": {"token_impacts": orphan_ti},
+        "pages_with_token_impacts": pages_ti
+    }
+
+def get_validation_flags(conn):
+    """Check for orphaned records and page coverage without counting every row."""
+    cursor = conn.cursor()
+    cursor.execute(VALIDATION_QUERY)
+    keys = ("orphaned_token_impacts", "orphaned_top_tokens", "has_token_impact_pages", "has_top_token_pages")
+    return dict(zip(keys, map(bool, cursor.fetchone())))
+
+def run_with_connection(db_path, func, *args):
+    """Run func on its own read-only connection so queries can execute in parallel threads."""
+    conn = get_db_connection(db_path)
+    try:
+        return func(conn, *args)
+    finally:
+        close_db(conn)
+
+def get_token_impact_stats(db_path="data/changelog.db", deep=True):
     """
     Get statistics on token impact data in the database.
     
     Args:
         db_path: Path to the database file
+        deep: Also run the join-heavy orphan and page coverage queries
     
     Returns:
         dict: Statistics on token impact data
     """
+    conn = None
     try:
         # Connect to the database
         conn = get_db_connection(db_path)
-        cursor = conn.cursor()
         
         # Check if required tables exist
         token_impacts_exists = check_table_exists(conn, "token_impacts")
@@ -76,86 +266,45 @@ def get_token_impact_stats(db_path="data/changelog.db"):
             },
             "counts": {},
             "schemas": {},
-            "sample_data": {}
-        }
-        
-        # Get counts for each table
-        if token_impacts_exists:
-            stats["counts"]["token_impacts"] = get_table_count(conn, "token_impacts")
-            stats["schemas"]["token_impacts"] = [dict(row) for row in get_table_schema(conn, "token_impacts")]
-            
-            # Get sample data
-            cursor.execute("SELECT * FROM token_impacts LIMIT 5")
-            stats["sample_data"]["token_impacts"] = [dict(row) for row in cursor.fetchall()]
-        
-        if token_impact_exists:
-            stats["counts"]["token_impact"] = get_table_count(conn, "token_impact")
-            stats["schemas"]["token_impact"] = [dict(row) for row in get_table_schema(conn, "token_impact")]
-            
-            # Get sample data
-            cursor.execute("SELECT * FROM token_impact LIMIT 5")
-            stats["sample_data"]["token_impact"] = [dict(row) for row in cursor.fetchall()]
-        
-        if top_tokens_exists:
-            stats["counts"]["top_tokens"] = get_table_count(conn, "top_tokens")
-            stats["schemas"]["top_tokens"] = [dict(row) for row in get_table_schema(conn, "top_tokens")]
-            
-            # Get sample data
-            cursor.execute("SELECT * FROM top_tokens LIMIT 5")
-            stats["sample_data"]["top_tokens"] = [dict(row) for row in cursor.fetchall()]
-        
-        # Get training metadata stats
-        stats["counts"]["training_metadata"] = get_table_count(conn, "training_metadata")
-        
-        # Get entries stats
-        stats["counts"]["entries"] = get_table_count(conn, "entries")
-        
-        # Get foreign key relationships
-        cursor.execute("PRAGMA foreign_key_list(token_impacts)")
-        stats["foreign_keys"] = {
-            "token_impacts": [dict(row) for row in cursor.fetchall()]
+            "sample_data": {},
+            "foreign_keys": {}
         }
         
-        if top_tokens_exists:
-            cursor.execute("PRAGMA foreign_key_list(top_tokens)")
-            stats["foreign_keys"]["top_tokens"] = [dict(row) for row in cursor.fetchall()]
-        
-        # Check for orphaned records
-        if token_impacts_exists:
-            cursor.execute("""
-                SELECT COUNT(*) FROM token_impacts ti
-                LEFT JOIN training_metadata tm ON ti.metadata_id = tm.id
-                WHERE tm.id IS NULL
-            """)
-            stats["orphaned"] = {
-                "token_impacts": cursor.fetchone()[0]
+        count_tables = [
+            table for table, exists in (
+                ("token_impacts", token_impacts_exists),
+                ("token_impact", token_impact_exists),
+                ("top_tokens", top_tokens_exists),
+                ("training_metadata", True),
+                ("entries", True)
+            ) if exists
+        ]
+        schema_tables = [
+            table for table, exists in (
+                ("token_impacts", token_impacts_exists),
+                ("token_impact", token_impact_exists),
+                ("top_tokens", top_tokens_exists)
+            ) if exists
+        ]
+        fk_tables = ["token_impacts", "top_tokens"] if top_tokens_exists else ["token_impacts"]
+        
+        # The remaining queries are independent; run them concurrently, each on
+        # its own read-only connection (SQLite releases the GIL while stepping)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                "counts": executor.submit(run_with_connection, db_path, get_table_counts, count_tables),
+                "schemas": executor.submit(run_with_connection, db_path, get_table_pragma, "table_info", schema_tables),
+                "sample_data": executor.submit(run_with_connection, db_path, get_sample_data, schema_tables),
+                "foreign_keys": executor.submit(run_with_connection, db_path, get_table_pragma, "foreign_key_list", fk_tables)
             }
-        
-        if top_tokens_exists and token_impacts_exists:
-            cursor.execute("""
-                SELECT COUNT(*) FROM top_tokens tt
-                LEFT JOIN token_impacts ti ON tt.token_impact_id = ti.id
-                WHERE ti.id IS NULL
-            """)
-            stats["orphaned"]["top_tokens"] = cursor.fetchone()[0]
-        
-        # Check for pages with token impact data
-        if token_impacts_exists:
-            cursor.execute("""
-                SELECT COUNT(DISTINCT e.page_id) FROM entries e
-                JOIN training_metadata tm ON e.id = tm.entry_id
-                JOIN token_impacts ti ON tm.id = ti.metadata_id
-            """)
-            stats["pages_with_token_impacts"] = cursor.fetchone()[0]
-        
-        if top_tokens_exists:
-            cursor.execute("""
-                SELECT COUNT(DISTINCT e.page_id) FROM entries e
-                JOIN training_metadata tm ON e.id = tm.entry_id
-                JOIN token_impacts ti ON tm.id = ti.metadata_id
-                JOIN top_tokens tt ON ti.id = tt.token_impact_id
-            """)
-            stats["pages_with_top_tokens"] = cursor.fetchone()[0]
+            coverage = None
+            if token_impacts_exists and deep:
+                coverage = executor.submit(run_with_connection, db_path, get_coverage_stats, top_tokens_exists)
+            
+            for key, future in futures.items():
+                stats[key] = future.result()
+            if coverage is not None:
+                stats.update(coverage.result())
         
         return stats
         
@@ -165,7 +314,7 @@ def get_token_impact_stats(db_path="data/changelog.db"):
         return {"error": str(e)}
     finally:
         if conn:
-            conn.close()
+            close_db(conn)
 
 def validate_token_impact_data(db_path="data/changelog.db"):
     """
@@ -178,8 +327,8 @@ def validate_token_impact_data(db_path="data/changelog.db"):
         bool: True if validation passed, False otherwise
     """
     try:
-        # Get token impact stats
-        stats = get_token_impact_stats(db_path)
+        # Get cheap token impact stats first; the join-heavy checks only run if these pass
+        stats = get_token_impact_stats(db_path, deep=False)
         
         # Print stats
         logger.info("Token Impact Data Statistics:")
@@ -206,21 +355,23 @@ def validate_token_impact_data(db_path="data/changelog.db"):
             logger.error("top_tokens table is empty")
             return False
         
+        flags = run_with_connection(db_path, get_validation_flags)
+        
         # Check for orphaned records
-        if stats.get("orphaned", {}).get("token_impacts", 0) > 0:
-            logger.error(f"Found {stats['orphaned']['token_impacts']} orphaned token_impacts records")
+        if flags["orphaned_token_impacts"]:
+            logger.error("Found orphaned token_impacts records")
             return False
         
-        if stats.get("orphaned", {}).get("top_tokens", 0) > 0:
-            logger.error(f"Found {stats['orphaned']['top_tokens']} orphaned top_tokens records")
+        if flags["orphaned_top_tokens"]:
+            logger.error("Found orphaned top_tokens records")
             return False
         
         # Check for pages with token impact data
-        if stats.get("pages_with_token_impacts", 0) == 0:
+        if not flags["has_token_impact_pages"]:
             logger.error("No pages have token impact data")
             return False
         
-        if stats.get("pages_with_top_tokens", 0) == 0:
+        if not flags["has_top_token_pages"]:
             logger.error("No pages have top tokens data")
             return False
         
@@ -232,56 +383,117 @@ def validate_token_impact_data(db_path="data/changelog.db"):
         logger.error(f"Exception type: {type(e).__name__}")
         return False
 
-def export_token_impact_data(db_path="data/changelog.db", output_path="token_impact_data.json"):
+def iter_export_pages(cursor):
+    """Group the rows of EXPORT_QUERY into one page dict per token impact."""
+    # Iterate the cursor in batches so SQLite streams rows instead of materializing them
+    for _, rows in groupby(rows_to_dicts(cursor), key=itemgetter("token_impact_id")):
+        rows = list(rows)
+        first = rows[0]
+        yield {
+            "page_id": first["page_id"],
+            "title": first["title"],
+            "total_tokens": first["total_tokens"],
+            "top_tokens": [
+                {
+                    "token_id": r["token_id"],
+                    "position": r["position"],
+                    "impact": r["impact"],
+                    "context": [r["context_start"], r["context_end"]]
+                }
+                for r in rows if r["token_id"] is not None
+            ]
+        }
+
+def produce_export_pages(db_path, pages, stop):
+    """
+    Producer for export_token_impact_data: stream grouped pages into a queue.
+    
+    Args:
+        db_path: Path to the database file
+        pages: Queue receiving page dicts, then any exception raised, then None
+        stop: Event set by the consumer when it stops reading, so a producer
+            blocked on a full queue can exit and release its connection
+    """
+    def put(item):
+        # Poll the stop event between bounded waits instead of blocking forever
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    conn = None
+    try:
+        # The producer needs its own connection since it runs in its own thread
+        conn = get_db_connection(db_path)
+        cursor = conn.cursor()
+        
+        # Get all pages with token impact data and their top tokens in a single query,
+        # ordered so each token impact's rows are contiguous
+        cursor.execute(EXPORT_QUERY)
+        for page in iter_export_pages(cursor):
+            if not put(page):
+                break
+    except Exception as e:
+        put(e)
+    finally:
+        if conn:
+            close_db(conn)
+        put(None)
+
+def encode_page(page, pretty=False):
+    """Encode a page dict as UTF-8 JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(page, option=orjson.OPT_INDENT_2 if pretty else 0)
+    return json.dumps(page, indent=2 if pretty else None).encode("utf-8")
+
+def export_token_impact_data(db_path="data/changelog.db", output_path="token_impact_data.json", pretty=False, ndjson=False):
     """
     Export token impact data to a JSON file.
     
     Args:
         db_path: Path to the database file
         output_path: Path to save the JSON file
+        pretty: Indent the JSON output (larger and slower to write)
+        ndjson: Write one compact JSON object per line instead of a JSON array
     
     Returns:
         bool: True if export was successful, False otherwise
     """
+    # Query and group pages in a producer thread (SQLite releases the GIL while
+    # stepping) while this thread encodes and writes them; the bounded queue
+    # keeps memory use to a few pages
+    pages = queue.Queue(maxsize=64)
+    stop = threading.Event()
+    producer = threading.Thread(target=produce_export_pages, args=(db_path, pages, stop))
+    producer.start()
+    
     try:
-        # Connect to the database
-        conn = get_db_connection(db_path)
-        cursor = conn.cursor()
-        
-        # Get all pages with token impact data
-        cursor.execute("""
-            SELECT e.page_id, e.title, ti.id as token_impact_id, ti.total_tokens
-            FROM entries e
-            JOIN training_metadata tm ON e.id = tm.entry_id
-            JOIN token_impacts ti ON tm.id = ti.metadata_id
-        """)
-        
-        pages = []
-        for row in cursor.fetchall():
-            page = dict(row)
-            token_impact_id = page.pop("token_impact_id")
-            
-            # Get top tokens for this token impact
-            cursor.execute("""
-                SELECT token_id, position, impact, context_start, context_end
-                FROM top_tokens
-                WHERE token_impact_id = ?
-            """, (token_impact_id,))
-            
-            top_tokens = []
-            for token_row in cursor.fetchall():
-                token = dict(token_row)
-                token["context"] = [token.pop("context_start"), token.pop("context_end")]
-                top_tokens.append(token)
-            
-            page["top_tokens"] = top_tokens
-            pages.append(page)
-        
-        # Save to JSON file
-        with open(output_path, "w") as f:
-            json.dump(pages, f, indent=2)
-        
-        logger.info(f"Exported token impact data for {len(pages)} pages to {output_path}")
+        page_count = 0
+        
+        # Stream pages to the JSON file one at a time so only the current page is held in memory
+        with open(output_path, "wb", buffering=1 << 20) as f:
+            if not ndjson:
+                f.write(b"[")
+            for page in iter(pages.get, None):
+                if isinstance(page, Exception):
+                    raise page
+                
+                if ndjson:
+                    f.write(encode_page(page) + b"\n")
+                else:
+                    if page_count:
+                        f.write(b",")
+                    if pretty:
+                        f.write(b"\n")
+                    f.write(encode_page(page, pretty))
+                page_count += 1
+            if not ndjson:
+                f.write(b"\n]\n" if pretty else b"]")
+        
+        logger.info(f"Exported token impact data for {page_count} pages to {output_path}")
         return True
         
     except Exception as e:
@@ -289,8 +501,9 @@ def export_token_impact_data(db_path="data/changelog.db", output_path="token_imp
         logger.error(f"Exception type: {type(e).__name__}")
         return False
     finally:
-        if conn:
-            conn.close()
+        # Unblock the producer if writing failed and wait for it to close its connection
+        stop.set()
+        producer.join()
 
 def main():
     parser = argparse.ArgumentParser(
@@ -311,6 +524,16 @@ def main():
         default="token_impact_data.json",
         help="Path to save the exported JSON file"
     )
+    parser.add_argument(
+        "--pretty",
+        action="store_true",
+        help="Indent the exported JSON file"
+    )
+    parser.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Export one JSON object per line instead of a JSON array"
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -363,7 +586,7 @@ def main():
         # Export token impact data if requested
         if args.export:
             print(f"\nExporting token impact data to {args.output}...")
-            export_token_impact_data(args.db_path, args.output)
+            export_token_impact_data(args.db_path, args.output, pretty=args.pretty, ndjson=args.ndjson)
     else:
         print("\nToken impact data validation FAILED")
         print("Please run scripts/fix_token_impact_tables.py to fix the database schema")
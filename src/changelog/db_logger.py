@@ -34,6 +34,15 @@ class ChangelogLogger:
         logger.info(f"Initializing ChangelogLogger with database path: {db_path}")
         self.db = ChangelogDB(db_path)
     
+    def bulk_update(self):
+        """
+        Run every operation in a with-block on one connection and one transaction.
+
+        Returns:
+            A context manager yielding the shared connection
+        """
+        return self.db.bulk_update()
+    
     def _compute_hash(self, content: str) -> str:
         """
         Compute SHA-256 hash of content.
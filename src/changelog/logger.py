@@ -4,10 +4,17 @@ Core changelog functionality for tracking Wikipedia page operations and training
 
 import json
 import hashlib
+import os
 import datetime
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Dict, Optional, List, Union
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class ChangelogLogger:
     """
     Manages the changelog for Wikipedia page operations and training metadata.
@@ -26,6 +33,8 @@ class ChangelogLogger:
             changelog_path: Path to the changelog JSON file
         """
         self.changelog_path = Path(changelog_path)
+        self._bulk_data: Optional[Dict] = None
+        self._dirty = False
         self._ensure_changelog_exists()
 
     def _ensure_changelog_exists(self) -> None:
@@ -36,13 +45,64 @@ class ChangelogLogger:
 
     def _read_changelog(self) -> Dict:
         """Read the current changelog."""
+        if self._bulk_data is not None:
+            return self._bulk_data
+        if orjson is not None:
+            return orjson.loads(self.changelog_path.read_bytes())
         with open(self.changelog_path, 'r', encoding='utf-8') as f:
             return json.load(f)
 
     def _write_changelog(self, data: Dict) -> None:
         """Write data to the changelog file."""
-        with open(self.changelog_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        if self._bulk_data is not None:
+            # Defer the rewrite until the enclosing bulk_update() exits
+            self._bulk_data = data
+            self._dirty = True
+            return
+        if orjson is not None:
+            # Same indented UTF-8 layout as the json fallback, encoded in C
+            payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        else:
+            payload = json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+        # Write a sibling file and rename it over the changelog, so a crash
+        # mid-write leaves the previous version intact instead of truncated JSON
+        tmp_path = self.changelog_path.with_name(self.changelog_path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.changelog_path)
+
+    @contextmanager
+    def bulk_update(self):
+        """
+        Batch changelog writes so the file is rewritten once instead of per entry.
+
+        Within the block, reads return the in-memory changelog and writes only
+        mark it dirty; the file is flushed once when the outermost block exits,
+        or left untouched if the block raises.
+        """
+        if self._bulk_data is not None:
+            # Nested block: the outermost one owns the flush
+            yield self
+            return
+
+        self._bulk_data = self._read_changelog()
+        self._dirty = False
+        try:
+            yield self
+        except BaseException:
+            # Discard the batch, matching the SQLite logger's rollback
+            self._bulk_data = None
+            self._dirty = False
+            raise
+
+        data, dirty = self._bulk_data, self._dirty
+        self._bulk_data = None
+        self._dirty = False
+        if dirty:
+            self._write_changelog(data)
 
     def _compute_hash(self, content: str) -> str:
         """
@@ -159,9 +219,11 @@ class ChangelogLogger:
         """
         changelog = self._read_changelog()
         timestamp = datetime.datetime.utcnow().isoformat() + "Z"
+        # Hash lookups instead of scanning page_ids once per entry
+        page_id_set = set(page_ids)
 
         for entry in changelog["entries"]:
-            if entry["page_id"] in page_ids:
+            if entry["page_id"] in page_id_set:
                 metadata_update = {
                     "used_in_training": True,
                     "training_timestamp": timestamp,
@@ -2,6 +2,6 @@
 Database package initialization for changelog-llm.
 """
 
-from src.db.db_schema import get_db_connection, init_db
+from src.db.db_schema import close_db, get_db_connection, init_db, shared_connection
 
-__all__ = ["get_db_connection", "init_db"]
\ No newline at end of file
+__all__ = ["close_db", "get_db_connection", "init_db", "shared_connection"]
\ No newline at end of file
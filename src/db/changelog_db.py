@@ -10,7 +10,7 @@ import datetime
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 
-from src.db.db_schema import init_db
+from src.db.db_schema import init_db, shared_connection
 from src.db.db_utils import (
     log_page, get_page_history, check_updates, mark_used_in_training, 
     get_unused_pages, get_page_revisions, get_main_pages, remove_unused_entries,
@@ -36,6 +36,15 @@ class ChangelogDB:
         self.db_path = db_path
         self.debug = debug
     
+    def bulk_update(self):
+        """
+        Run every operation in a with-block on one connection and one transaction.
+        
+        Returns:
+            A context manager yielding the shared connection
+        """
+        return shared_connection(self.db_path, transaction=True)
+    
     def _compute_hash(self, content: str) -> str:
         """
         Compute SHA-256 hash of content.
@@ -7,9 +7,53 @@ for database initialization.
 import json
 import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional
 
+# Top tokens are always read per token impact, so they are clustered on
+# (token_impact_id, position) instead of a synthetic rowid
+TOP_TOKENS_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS top_tokens (
+    token_impact_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    token_id INTEGER NOT NULL,
+    impact REAL NOT NULL,
+    context_start INTEGER NOT NULL,
+    context_end INTEGER NOT NULL,
+    PRIMARY KEY (token_impact_id, position),
+    FOREIGN KEY (token_impact_id) REFERENCES token_impacts (id) ON DELETE CASCADE
+) WITHOUT ROWID
+'''
+
+# Tables whose row counts are cached in _counts
+COUNTED_TABLES = ("entries", "training_metadata", "token_impacts", "top_tokens")
+
+# Default database file under the project's data directory, resolved once at import
+# rather than walking the filesystem on every connection
+DEFAULT_DB_PATH = os.path.join(Path(__file__).resolve().parent.parent.parent, "data", "changelog.db")
+
+# Per-thread writer connection reused by get_db_connection inside shared_connection()
+_shared = threading.local()
+
+class ChangelogConnection(sqlite3.Connection):
+    """Connection whose commits can be deferred to batch many writes into one transaction."""
+    
+    defer_commit = False
+    failed = False
+    
+    def commit(self) -> None:
+        if not self.defer_commit:
+            super().commit()
+    
+    def rollback(self) -> None:
+        # A rollback while commits are deferred discards the whole batch so far;
+        # flag it so shared_connection fails the block instead of committing the rest
+        if self.defer_commit:
+            self.failed = True
+        super().rollback()
+
 def get_db_connection(db_path: Optional[str] = None) -> sqlite3.Connection:
     """
     Create and return a connection to the SQLite database.
@@ -25,25 +69,31 @@ def get_db_connection(db_path: Optional[str] = None) -> sqlite3.Connection:
     
     try:
         if db_path is None:
-            # Default to a database file next to this module
-            parent_dir = Path(__file__).resolve().parent.parent.parent
-            db_path = os.path.join(parent_dir, "data", "changelog.db")
+            db_path = DEFAULT_DB_PATH
+        
+        shared_conn = getattr(_shared, "conn", None)
+        if shared_conn is not None and os.path.abspath(db_path) == _shared.path:
+            return shared_conn
         
         logger.info(f"Opening database connection to: {db_path}")
         
         # Ensure directory exists
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        db_uri = f"file:{db_path}?mode=rwc"
         
         # Connect to the database and enable foreign keys
         # Use URI mode to specify encoding parameters
-        db_uri = f"file:{db_path}?mode=rwc"
-        conn = sqlite3.connect(db_uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn = sqlite3.connect(db_uri, uri=True, cached_statements=256, factory=ChangelogConnection)
         conn.execute("PRAGMA foreign_keys = ON")
-        conn.row_factory = sqlite3.Row
         
-        # Configure text factory to handle binary data
-        # Use bytes as text factory to avoid encoding issues
-        conn.text_factory = bytes
+        # Performance settings: WAL journaling, relaxed fsync, in-memory temp
+        # tables, a 64 MiB page cache and 256 MiB of mmap I/O
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -65536")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        conn.row_factory = sqlite3.Row
         
         logger.info("Database connection established successfully")
         return conn
@@ -52,6 +102,143 @@ def get_db_connection(db_path: Optional[str] = None) -> sqlite3.Connection:
         logger.error(f"Exception type: {type(e).__name__}")
         raise
 
+def close_db(conn: sqlite3.Connection) -> None:
+    """
+    Close a database connection, letting SQLite refresh planner statistics first.
+    
+    Args:
+        conn (sqlite3.Connection): Connection to close
+    """
+    if conn is getattr(_shared, "conn", None):
+        # Owned by the enclosing shared_connection() block; discard uncommitted
+        # work as closing a per-call connection would, unless it is batching commits
+        if conn.in_transaction and not conn.defer_commit:
+            conn.rollback()
+        return
+    
+    try:
+        # Usually a no-op; runs ANALYZE on tables whose queries would benefit
+        conn.execute("PRAGMA optimize")
+    except sqlite3.Error:
+        # Read-only connections and database files cannot store statistics
+        pass
+    finally:
+        conn.close()
+
+@contextmanager
+def shared_connection(db_path: Optional[str] = None, transaction: bool = False):
+    """
+    Reuse one connection for every get_db_connection call made in the block.
+    
+    Each call otherwise reopens the file, maps the WAL index and reapplies the
+    pragmas, and its page cache is dropped on close; bulk callers keep a single
+    connection open instead. Nested blocks share the outermost connection.
+    
+    Args:
+        db_path (str, optional): Path to the database file
+        transaction (bool): Defer every commit in the block to a single one on
+            exit, rolling back instead if the block raises or any operation in
+            it rolled back
+        
+    Yields:
+        sqlite3.Connection: The shared connection
+    """
+    if getattr(_shared, "conn", None) is not None:
+        yield _shared.conn
+        return
+    
+    conn = get_db_connection(db_path)
+    conn.defer_commit = transaction
+    _shared.conn = conn
+    _shared.path = os.path.abspath(conn.execute("PRAGMA database_list").fetchone()[2])
+    try:
+        yield conn
+        conn.defer_commit = False
+        if conn.failed:
+            raise sqlite3.DatabaseError("An operation rolled back the shared transaction; no changes were committed")
+        conn.commit()
+    except BaseException:
+        conn.defer_commit = False
+        conn.rollback()
+        raise
+    finally:
+        _shared.conn = None
+        close_db(conn)
+
+# One-time rebuild of a top_tokens table created with the old synthetic id column
+MIGRATE_TOP_TOKENS_SQL = '''
+ALTER TABLE top_tokens RENAME TO top_tokens_rowid;
+%s;
+INSERT OR REPLACE INTO top_tokens (
+    token_impact_id, position, token_id, impact, context_start, context_end
+)
+SELECT token_impact_id, position, token_id, impact, context_start, context_end
+FROM top_tokens_rowid
+ORDER BY id;
+DROP TABLE top_tokens_rowid;
+''' % TOP_TOKENS_TABLE_SQL.strip()
+
+SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    page_id TEXT NOT NULL UNIQUE,
+    revision_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    action TEXT NOT NULL,
+    is_revision BOOLEAN NOT NULL,
+    parent_id TEXT,
+    revision_number INTEGER,
+    FOREIGN KEY (parent_id) REFERENCES entries (page_id)
+);
+
+CREATE TABLE IF NOT EXISTS training_metadata (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    entry_id INTEGER NOT NULL,
+    used_in_training BOOLEAN NOT NULL DEFAULT 0,
+    training_timestamp TEXT,
+    model_checkpoint TEXT,
+    average_loss REAL,
+    relative_loss REAL,
+    FOREIGN KEY (entry_id) REFERENCES entries (id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS token_impacts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    metadata_id INTEGER NOT NULL,
+    total_tokens INTEGER NOT NULL,
+    FOREIGN KEY (metadata_id) REFERENCES training_metadata (id) ON DELETE CASCADE
+);
+
+%s;
+
+-- Create indices for faster querying
+CREATE INDEX IF NOT EXISTS idx_entries_page_id ON entries (page_id);
+CREATE INDEX IF NOT EXISTS idx_entries_parent_id ON entries (parent_id);
+CREATE INDEX IF NOT EXISTS idx_training_metadata_entry_id ON training_metadata (entry_id);
+CREATE INDEX IF NOT EXISTS idx_token_impacts_metadata_id ON token_impacts (metadata_id);
+
+-- Row counts maintained by triggers, since SQLite rescans the table for every COUNT(*)
+CREATE TABLE IF NOT EXISTS _counts (
+    table_name TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+);
+''' % TOP_TOKENS_TABLE_SQL.strip()
+
+# (Re)seeds a table's cached count in the same transaction that creates its triggers
+COUNT_TRIGGERS_SQL = '''
+INSERT OR REPLACE INTO _counts (table_name, n) SELECT '{table}', COUNT(*) FROM {table};
+CREATE TRIGGER IF NOT EXISTS {table}_count_insert AFTER INSERT ON {table}
+BEGIN
+    UPDATE _counts SET n = n + 1 WHERE table_name = '{table}';
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_count_delete AFTER DELETE ON {table}
+BEGIN
+    UPDATE _counts SET n = n - 1 WHERE table_name = '{table}';
+END;
+'''
+
 def init_db(db_path: Optional[str] = None) -> None:
     """
     Initialize the database with the required schema.
@@ -63,67 +250,24 @@ def init_db(db_path: Optional[str] = None) -> None:
     conn = get_db_connection(db_path)
     cursor = conn.cursor()
     
-    # Create tables
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS entries (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        page_id TEXT NOT NULL UNIQUE,
-        revision_id TEXT NOT NULL,
-        timestamp TEXT NOT NULL,
-        content_hash TEXT NOT NULL,
-        action TEXT NOT NULL,
-        is_revision BOOLEAN NOT NULL,
-        parent_id TEXT,
-        revision_number INTEGER,
-        FOREIGN KEY (parent_id) REFERENCES entries (page_id)
-    )
-    ''')
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS training_metadata (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        entry_id INTEGER NOT NULL,
-        used_in_training BOOLEAN NOT NULL DEFAULT 0,
-        training_timestamp TEXT,
-        model_checkpoint TEXT,
-        average_loss REAL,
-        relative_loss REAL,
-        FOREIGN KEY (entry_id) REFERENCES entries (id) ON DELETE CASCADE
-    )
-    ''')
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS token_impacts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        metadata_id INTEGER NOT NULL,
-        total_tokens INTEGER NOT NULL,
-        FOREIGN KEY (metadata_id) REFERENCES training_metadata (id) ON DELETE CASCADE
-    )
-    ''')
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS top_tokens (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        token_impact_id INTEGER NOT NULL,
-        token_id INTEGER NOT NULL,
-        position INTEGER NOT NULL,
-        impact REAL NOT NULL,
-        context_start INTEGER NOT NULL,
-        context_end INTEGER NOT NULL,
-        FOREIGN KEY (token_impact_id) REFERENCES token_impacts (id) ON DELETE CASCADE
-    )
-    ''')
+    # Inspect the existing schema to decide which one-time steps are needed
+    cursor.execute("SELECT name FROM pragma_table_info('top_tokens')")
+    migrate_top_tokens = "id" in {row[0] for row in cursor.fetchall()}
+    cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger')")
+    existing = {row[0] for row in cursor.fetchall()}
     
-    # Create indices for faster querying
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_entries_page_id ON entries (page_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_entries_parent_id ON entries (parent_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_training_metadata_entry_id ON training_metadata (entry_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_token_impacts_metadata_id ON token_impacts (metadata_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_top_tokens_token_impact_id ON top_tokens (token_impact_id)')
+    # Build the whole schema as one script so it is parsed once and applied in a single transaction
+    script = ["BEGIN;"]
+    if migrate_top_tokens:
+        script.append(MIGRATE_TOP_TOKENS_SQL)
+    script.append(SCHEMA_SQL)
+    for table in COUNTED_TABLES:
+        if f"{table}_count_insert" not in existing or f"{table}_count_delete" not in existing:
+            script.append(COUNT_TRIGGERS_SQL.format(table=table))
+    script.append("COMMIT;")
     
-    conn.commit()
-    conn.close()
+    conn.executescript("\n".join(script))
+    close_db(conn)
 
 if __name__ == "__main__":
     init_db()
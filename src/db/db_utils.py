@@ -9,7 +9,7 @@ from pathlib import Path
 from typing import Dict, List, Optional, Any, Union
 import sqlite3
 
-from src.db.db_schema import get_db_connection, init_db
+from src.db.db_schema import close_db, get_db_connection, init_db
 
 def create_training_run(model_name: str, base_model: str, hyperparameters: Dict, git_commit: Optional[str] = None) -> int:
     """
@@ -46,7 +46,7 @@ def create_training_run(model_name: str, base_model: str, hyperparameters: Dict,
     
     run_id = cursor.lastrowid
     conn.commit()
-    conn.close()
+    close_db(conn)
     
     if run_id is None:
         return -1  # Return a sentinel value if no ID was generated
@@ -75,7 +75,7 @@ def update_training_run_status(run_id: int, status: str, metrics: Optional[Dict]
     result = cursor.fetchone()
     
     if not result:
-        conn.close()
+        close_db(conn)
         return False
     
     # Update metrics
@@ -92,7 +92,7 @@ def update_training_run_status(run_id: int, status: str, metrics: Optional[Dict]
     
     success = cursor.rowcount > 0
     conn.commit()
-    conn.close()
+    close_db(conn)
     
     return success
 
@@ -128,7 +128,7 @@ def add_training_examples(run_id: int, examples: List[Dict]) -> int:
         count += 1
     
     conn.commit()
-    conn.close()
+    close_db(conn)
     
     return count
 
@@ -159,7 +159,7 @@ def add_model_output(run_id: int, input_text: str, output_text: str, metadata: O
     
     output_id = cursor.lastrowid
     conn.commit()
-    conn.close()
+    close_db(conn)
     
     if output_id is None:
         return -1  # Return a sentinel value if no ID was generated
@@ -183,7 +183,7 @@ def get_training_run(run_id: int) -> Optional[Dict]:
     ''', (run_id,))
     
     result = cursor.fetchone()
-    conn.close()
+    close_db(conn)
     
     if not result:
         return None
@@ -212,7 +212,7 @@ def get_all_training_runs() -> List[Dict]:
     ''')
     
     runs = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    close_db(conn)
     
     return runs
 
@@ -262,7 +262,7 @@ def get_training_examples(run_id: Optional[int] = None, example_type: Optional[s
         example['metadata'] = json.loads(example['metadata'])
         examples.append(example)
     
-    conn.close()
+    close_db(conn)
     
     return examples
 
@@ -339,7 +339,7 @@ def log_page(title: str, page_id: str, revision_id: str, content_hash: str, acti
             entry_id = cursor.fetchone()['id']
             return entry_id
     finally:
-        conn.close()
+        close_db(conn)
 
 def mark_used_in_training(page_ids: List[str], model_checkpoint: str, 
                           training_metrics: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
@@ -446,27 +446,30 @@ def mark_used_in_training(page_ids: List[str], model_checkpoint: str,
                     logger.info(f"Found {len(top_tokens)} top tokens to process")
                     print(f"DEBUG: Found {len(top_tokens)} top tokens to process")
                     
+                    # Validate and collect rows first so the whole page is inserted with one
+                    # executemany; a bad token is skipped here instead of failing the batch
+                    top_token_rows = []
+                    seen_positions = set()
                     for token in top_tokens:
                         try:
-                            position = token['position']
+                            position = int(token['position'])
                             # Handle context data safely
                             context = token.get('context', [position, position])
                             if not isinstance(context, list) or len(context) < 2:
                                 context = [position, position]
                             
-                            context_start = context[0]
-                            context_end = context[1]
+                            context_start = int(context[0])
+                            context_end = int(context[1])
                             
                             # Ensure token_id is an integer
                             token_id = int(token['token_id'])
                             
-                            # Insert into top_tokens table
-                            cursor.execute('''
-                                INSERT INTO top_tokens (
-                                    token_impact_id, token_id, position, impact,
-                                    context_start, context_end
-                                ) VALUES (?, ?, ?, ?, ?, ?)
-                            ''', (
+                            # Positions are the top_tokens primary key within a token impact
+                            if position in seen_positions:
+                                raise ValueError(f"duplicate position {position}")
+                            seen_positions.add(position)
+                            
+                            top_token_rows.append((
                                 token_impact_id,
                                 token_id,
                                 position,
@@ -480,7 +483,25 @@ def mark_used_in_training(page_ids: List[str], model_checkpoint: str,
                             logger.error(f"Token data: {token}")
                             # Continue with next token
                             continue
-                
+
+                    # Insert into top_tokens table
+                    if top_token_rows:
+                        # A savepoint makes the page's batch all-or-nothing; executemany
+                        # alone would keep the rows inserted before a failing one
+                        cursor.execute("SAVEPOINT top_tokens")
+                        try:
+                            cursor.executemany('''
+                                INSERT INTO top_tokens (
+                                    token_impact_id, token_id, position, impact,
+                                    context_start, context_end
+                                ) VALUES (?, ?, ?, ?, ?, ?)
+                            ''', top_token_rows)
+                        except sqlite3.Error as e:
+                            cursor.execute("ROLLBACK TO top_tokens")
+                            logger.error(f"Skipped all {len(top_token_rows)} top tokens for page_id={page_id}: {str(e)}")
+                        finally:
+                            cursor.execute("RELEASE top_tokens")
+
                 except Exception as e:
                     logger.error(f"Error processing token impact data: {str(e)}")
                     logger.error(f"Token impact data: {token_impact}")
@@ -488,7 +509,7 @@ def mark_used_in_training(page_ids: List[str], model_checkpoint: str,
                     continue
     
     conn.commit()
-    conn.close()
+    close_db(conn)
 
 def get_page_by_id(page_id: str) -> Optional[Dict]:
     """
@@ -512,7 +533,7 @@ def get_page_by_id(page_id: str) -> Optional[Dict]:
     ''', (page_id,))
     
     row = cursor.fetchone()
-    conn.close()
+    close_db(conn)
     
     if not row:
         return None
@@ -555,7 +576,7 @@ def get_page_history(page_id: str) -> List[Dict]:
             print(f"Error querying database: {str(e)}")
             return []
         finally:
-            conn.close()
+            close_db(conn)
         
         return entries
     except Exception as e:
@@ -590,7 +611,7 @@ def check_updates(page_id: str, revision_id: str) -> bool:
             
             if count == 0:
                 logger.info(f"No existing entry found for page_id={page_id}, needs adding")
-                conn.close()
+                close_db(conn)
                 return True  # No existing entry, needs adding
             
             # If we get here, the page exists, so get its revision_id
@@ -609,12 +630,7 @@ def check_updates(page_id: str, revision_id: str) -> bool:
                 logger.warning(f"Strange: count was {count} but no result found")
                 return True
             
-            # Get the revision_id as bytes and decode it safely
-            db_revision_id_bytes = result[0]
-            if isinstance(db_revision_id_bytes, bytes):
-                db_revision_id = db_revision_id_bytes.decode('utf-8', errors='replace')
-            else:
-                db_revision_id = str(db_revision_id_bytes)
+            db_revision_id = str(result[0])
             
             logger.info(f"Comparing revision IDs: {db_revision_id} vs {revision_id}")
             return db_revision_id != revision_id
@@ -625,7 +641,7 @@ def check_updates(page_id: str, revision_id: str) -> bool:
             # If there's an error, assume we need to add the page
             return True
         finally:
-            conn.close()
+            close_db(conn)
             
     except Exception as e:
         logger.error(f"Unexpected error in check_updates: {str(e)}")
@@ -651,7 +667,7 @@ def get_unused_pages() -> List[Dict]:
     ''')
     
     entries = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    close_db(conn)
     
     return entries
 
@@ -678,7 +694,7 @@ def get_page_revisions(page_id: str) -> List[Dict]:
     ''', (page_id,))
     
     revisions = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    close_db(conn)
     
     return revisions
 
@@ -724,7 +740,7 @@ def get_main_pages() -> List[Dict]:
             if "relative_loss" not in page:
                 page["relative_loss"] = None
             pages.append(page)
-        conn.close()
+        close_db(conn)
         
         return pages
     except Exception as e:
@@ -776,7 +792,7 @@ def remove_unused_entries() -> int:
         conn.rollback()
         return 0
     finally:
-        conn.close()
+        close_db(conn)
 
 def export_to_json(output_path: str = "changelog_export.json") -> bool:
     """
@@ -790,6 +806,8 @@ def export_to_json(output_path: str = "changelog_export.json") -> bool:
     """
     conn = get_db_connection()
     cursor = conn.cursor()
+    # Separate cursor for the per-entry lookups so the entries scan can stream
+    lookup_cursor = conn.cursor()
     
     # Get all entries with their training metadata
     cursor.execute('''
@@ -801,7 +819,7 @@ def export_to_json(output_path: str = "changelog_export.json") -> bool:
     ''')
     
     entries = []
-    for row in cursor.fetchall():
+    for row in cursor:
         entry = dict(row)
         metadata_id = entry.pop('metadata_id')
         
@@ -817,26 +835,26 @@ def export_to_json(output_path: str = "changelog_export.json") -> bool:
         
         # Get token impact data if it exists
         if metadata_id is not None:
-            cursor.execute('''
+            lookup_cursor.execute('''
                 SELECT id, total_tokens
                 FROM token_impacts
                 WHERE metadata_id = ?
             ''', (metadata_id,))
             
-            token_impact_row = cursor.fetchone()
+            token_impact_row = lookup_cursor.fetchone()
             if token_impact_row:
                 token_impact_id = token_impact_row['id']
                 total_tokens = token_impact_row['total_tokens']
                 
                 # Get top tokens
-                cursor.execute('''
+                lookup_cursor.execute('''
                     SELECT token_id, position, impact, context_start, context_end
                     FROM top_tokens
                     WHERE token_impact_id = ?
                 ''', (token_impact_id,))
                 
                 top_tokens = []
-                for token_row in cursor.fetchall():
+                for token_row in lookup_cursor:
                     top_tokens.append({
                         "token_id": token_row['token_id'],
                         "position": token_row['position'],
@@ -852,7 +870,7 @@ def export_to_json(output_path: str = "changelog_export.json") -> bool:
         entry["training_metadata"] = training_metadata
         entries.append(entry)
     
-    conn.close()
+    close_db(conn)
     
     # Create output JSON
     json_data = {"entries": entries}
@@ -150,7 +150,7 @@ class CustomTransformer(nn.Module):
         
         # Load state dict
         state_dict_path = Path(path) / "pytorch_model.bin"
-        state_dict = torch.load(state_dict_path)
+        state_dict = torch.load(state_dict_path, map_location="cpu")
         model.load_state_dict(state_dict)
         
         return model
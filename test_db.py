@@ -178,6 +178,134 @@ def test_logger_interface():
     
     return True
 
+def test_top_tokens_migration():
+    """Test migrating an old top_tokens table and the trigger-maintained row counts."""
+    logger.info("Testing top_tokens migration and cached row counts...")
+    
+    try:
+        from src.db.db_schema import COUNTED_TABLES, get_db_connection, init_db
+        
+        test_db_path = os.path.join(project_root, "data", "test_migration.db")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(test_db_path + suffix):
+                os.remove(test_db_path + suffix)
+        
+        # Build a database with the old rowid-based top_tokens table
+        conn = sqlite3.connect(test_db_path)
+        conn.executescript('''
+            CREATE TABLE entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                page_id TEXT NOT NULL UNIQUE,
+                revision_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                action TEXT NOT NULL,
+                is_revision BOOLEAN NOT NULL,
+                parent_id TEXT,
+                revision_number INTEGER
+            );
+            CREATE TABLE training_metadata (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                entry_id INTEGER NOT NULL,
+                used_in_training BOOLEAN NOT NULL DEFAULT 0,
+                training_timestamp TEXT,
+                model_checkpoint TEXT,
+                average_loss REAL,
+                relative_loss REAL
+            );
+            CREATE TABLE token_impacts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                metadata_id INTEGER NOT NULL,
+                total_tokens INTEGER NOT NULL
+            );
+            CREATE TABLE top_tokens (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                token_impact_id INTEGER NOT NULL,
+                token_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                impact REAL NOT NULL,
+                context_start INTEGER NOT NULL,
+                context_end INTEGER NOT NULL
+            );
+            CREATE INDEX idx_top_tokens_token_impact_id ON top_tokens (token_impact_id);
+        ''')
+        for i in range(1, 4):
+            conn.execute(
+                "INSERT INTO entries VALUES (?, 'Page', ?, 'rev1', 'ts', 'hash', 'added', 0, NULL, NULL)",
+                (i, f"page{i}")
+            )
+            conn.execute("INSERT INTO training_metadata (id, entry_id, used_in_training) VALUES (?, ?, 1)", (i, i))
+            conn.execute("INSERT INTO token_impacts (id, metadata_id, total_tokens) VALUES (?, ?, 100)", (i, i))
+            for position in range(5):
+                conn.execute(
+                    "INSERT INTO top_tokens (token_impact_id, token_id, position, impact, context_start, context_end) "
+                    "VALUES (?, ?, ?, 0.5, ?, ?)",
+                    (i, 40 + position, position, max(0, position - 2), position + 3)
+                )
+        conn.commit()
+        conn.close()
+        
+        # Migrate, then run again to check the migration is idempotent
+        init_db(test_db_path)
+        init_db(test_db_path)
+        
+        conn = get_db_connection(test_db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT COUNT(*) FROM top_tokens")
+        top_token_count = cursor.fetchone()[0]
+        if top_token_count != 15:
+            logger.error(f"Migration changed the top_tokens row count: expected 15, got {top_token_count}")
+            return False
+        
+        cursor.execute("SELECT name FROM pragma_table_info('top_tokens') WHERE pk > 0 ORDER BY pk")
+        primary_key = [row[0] for row in cursor.fetchall()]
+        if primary_key != ["token_impact_id", "position"]:
+            logger.error(f"Unexpected top_tokens primary key: {primary_key}")
+            return False
+        
+        def counts_match():
+            for table in COUNTED_TABLES:
+                cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                actual = cursor.fetchone()[0]
+                cursor.execute("SELECT n FROM _counts WHERE table_name = ?", (table,))
+                row = cursor.fetchone()
+                if row is None or row[0] != actual:
+                    logger.error(f"_counts for {table} is {row[0] if row else None}, expected {actual}")
+                    return False
+            return True
+        
+        if not counts_match():
+            return False
+        
+        # Inserts, a direct delete and a cascading delete must all keep the counts exact
+        cursor.execute(
+            "INSERT INTO top_tokens (token_impact_id, position, token_id, impact, context_start, context_end) "
+            "VALUES (1, 5, 99, 0.1, 3, 8)"
+        )
+        cursor.execute("DELETE FROM top_tokens WHERE token_impact_id = 2 AND position = 0")
+        cursor.execute("DELETE FROM token_impacts WHERE id = 3")
+        conn.commit()
+        
+        if not counts_match():
+            return False
+        
+        logger.info("top_tokens migration and cached row counts verified")
+        conn.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(test_db_path + suffix):
+                os.remove(test_db_path + suffix)
+        
+    except ImportError as e:
+        logger.error(f"Import error: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Error testing top_tokens migration: {e}")
+        return False
+    
+    return True
+
 def main():
     """Run all tests."""
     success = True
@@ -194,6 +322,10 @@ def main():
         logger.error("Logger interface test failed")
         success = False
     
+    if not test_top_tokens_migration():
+        logger.error("top_tokens migration test failed")
+        success = False
+    
     if success:
         logger.info("All tests passed!")
     else: